@@ -40,7 +40,8 @@ class Client:
         self.global_model = global_model
         self.gm_skeleton = utils.weights.skeleton(self.global_model)
         self.lm_skeleton = utils.weights.skeleton(self.model)
-        partitioned_gweights = utils.weights.partition(self.global_model.get_weights(), self.gm_skeleton, self.lm_skeleton)
+        self.partitions = utils.weights.partitioner(self.gm_skeleton, self.lm_skeleton)
+        partitioned_gweights = utils.weights.partition_with(self.global_model.get_weights(), self.partitions)
         self.classifer_layers = classifier_layers
         self.model.set_weights(partitioned_gweights)
         self.eta_0 = eta
@@ -84,7 +85,7 @@ class Client:
             utils.weights.scale(global_update, min(eta / utils.norm(global_update), 1))
         ))
         self.round += 1
-        partitioned_gweights = utils.partition(self.global_model.get_weights(), self.gm_skeleton, self.lm_skeleton)
+        partitioned_gweights = utils.weights.partition_with(self.global_model.get_weights(), self.partitions)
         if self.training_type == "GMS":
             self.model.set_weights(partitioned_gweights)
         for _ in range(self.epochs):
@@ -100,7 +101,7 @@ class Client:
             self.global_model.get_weights(),
             utils.weights.div(global_grad, utils.weights.maximum(counter, 1))
         ))
-        partitioned_gweights = utils.partition(self.global_model.get_weights(), self.gm_skeleton, self.lm_skeleton)
+        partitioned_gweights = utils.weights.partition_with(self.global_model.get_weights(), self.partitions)
         if self.training_type == "GMS":
             self.model.set_weights(partitioned_gweights)
         for _ in range(self.epochs):
@@ -8,7 +8,7 @@ import numpy as np
 class DataIter:
     """Iterator that gives random batchs in pairs of (X_i, y_i) for i in {1, ..., N}"""
 
-    def __init__(self, X, y, batch_size, classes, rng):
+    def __init__(self, X, y, batch_size, classes, rng, epoch_shuffle=True, indices=None):
         """
         Construct a data iterator.
 
@@ -18,36 +18,77 @@ class DataIter:
         - batch_size: the batch size
         - classes: the number of classes
         - rng: the random number generator
+        - epoch_shuffle: if True, batches are consecutive slices of a permutation drawn once per epoch,
+          otherwise each batch is sampled independently
+        - indices: the indices of X and y that this iterator covers, batches are gathered from X and y through these
+          so the data is not copied (default: all of the samples)
         """
         self.X = X
         self.y = y
-        self.batch_size = y.shape[0] if batch_size is None else min(batch_size, y.shape[0])
-        self.idx = np.arange(y.shape[0])
+        self.indices = np.arange(y.shape[0], dtype=np.int32) if indices is None else indices
+        self.n = self.indices.shape[0]
+        self.batch_size = self.n if batch_size is None else min(batch_size, self.n)
         self.classes = classes
         self.rng = rng
+        self.epoch_shuffle = epoch_shuffle
+        self._perm = None
+        self._cursor = 0
 
     def __iter__(self):
-        """Return this as an iterator."""
+        """Return this as an iterator, starting a new epoch."""
+        self._shuffle()
         return self
 
     def __next__(self):
         """Get a random batch."""
-        idx = self.rng.choice(self.idx, self.batch_size, replace=False)
+        if self.epoch_shuffle:
+            if self._perm is None or self._cursor + self.batch_size > self.n:
+                self._shuffle()
+            idx = self._perm[self._cursor:self._cursor + self.batch_size]
+            self._cursor += self.batch_size
+        else:
+            idx = self._sample_idx()
+        idx = self.indices[idx]
         return self.X[idx], self.y[idx]
 
+    def _shuffle(self):
+        """Draw the permutation for a new epoch."""
+        self._perm = self.rng.permutation(self.n)
+        self._cursor = 0
+
+    def _sample_idx(self):
+        """
+        Draw batch_size distinct indices, drawing directly with integers when the batch is small relative to the
+        data and falling back to a permutation otherwise.
+        """
+        if self.batch_size >= self.n / 2:
+            return self.rng.permutation(self.n)[:self.batch_size]
+        idx = np.unique(self.rng.integers(0, self.n, size=self.batch_size * 2))
+        while idx.shape[0] < self.batch_size:
+            idx = np.union1d(idx, self.rng.integers(0, self.n, size=self.batch_size * 2))
+        # np.unique sorts its output, so shuffle before truncating to keep the batch uniformly random
+        self.rng.shuffle(idx)
+        return idx[:self.batch_size]
+
     def map(self, f):
-        self.X, self.y = f(self.X, self.y)
-        self.idx = np.arange(self.y.shape[0])
-        self.batch_size = self.y.shape[0] if self.batch_size is None else min(self.batch_size, self.y.shape[0])
+        """Apply f to the samples and labels, this materialises the covered subset as the iterator's own data."""
+        self.X, self.y = f(self.X[self.indices], self.y[self.indices])
+        self.indices = np.arange(self.y.shape[0], dtype=np.int32)
+        self._reset_indices()
         return self
 
     def filter(self, f):
-        idx = f(self.y)
-        self.X, self.y = self.X[idx], self.y[idx]
-        self.idx = np.arange(self.y.shape[0])
-        self.batch_size = self.y.shape[0] if self.batch_size is None else min(self.batch_size, self.y.shape[0])
+        """Keep only the samples whose labels f selects."""
+        self.indices = self.indices[f(self.y[self.indices])]
+        self._reset_indices()
         return self
 
+    def _reset_indices(self):
+        """Update the derived state after the covered indices have changed."""
+        self.n = self.indices.shape[0]
+        self.batch_size = min(self.batch_size, self.n)
+        self._perm = None
+
 
 class Dataset:
     """Object that contains the full dataset, primarily to prevent the need for reloading for each client."""
@@ -60,20 +101,28 @@ class Dataset:
         - y: the labels
         - train: the training indices
         """
-        self.X, self.y, self.train_idx = X, y, train
-        self.classes = np.unique(self.y).shape[0]
+        # Read-only views, the iterators gather from these rather than holding their own copies
+        self._X, self._y = X.view(), y.view()
+        self._X.setflags(write=False)
+        self._y.setflags(write=False)
+        self.train_idx = train
+        self.classes = np.unique(self._y).shape[0]
         self.input_shape = X.shape[1:]
 
     def train(self):
         """Get the training subset"""
-        return self.X[self.train_idx], self.y[self.train_idx]
+        return self._X[self.train_idx], self._y[self.train_idx]
 
     def test(self):
         """Get the testing subset"""
-        return self.X[~self.train_idx], self.y[~self.train_idx]
+        return self._X[~self.train_idx], self._y[~self.train_idx]
+
+    def split_indices(self, split):
+        """Get the indices of the samples in the split"""
+        return np.flatnonzero(self.train_idx if split == 'train' else ~self.train_idx).astype(np.int32)
 
     def get_iter(
-        self, split, batch_size=None, idx=None, filter=None, map=None, rng=np.random.default_rng()
+        self, split, batch_size=None, idx=None, filter=None, map=None, rng=np.random.default_rng(), epoch_shuffle=True
     ) -> DataIter:
         """
         Generate an iterator out of the dataset.
@@ -85,19 +134,19 @@ class Dataset:
         - filter: a function that takes the labels and returns whether to keep the sample
         - map: a function that takes the samples and labels and returns a subset of the samples and labels
         - rng: the random number generator
+        - epoch_shuffle: whether the iterator slices batches from a per-epoch permutation
         """
-        X, y = self.train() if split == 'train' else self.test()
-        X, y = X.copy(), y.copy()
+        indices = self.split_indices(split)
         if idx is not None:
-            X, y = X[idx], y[idx]
+            indices = indices[idx]
         if filter is not None:
-            fidx = filter(y)
-            X, y = X[fidx], y[fidx]
+            indices = indices[filter(self._y[indices])]
+        data_iter = DataIter(self._X, self._y, batch_size, self.classes, rng, epoch_shuffle=epoch_shuffle, indices=indices)
         if map is not None:
-            X, y = map(X, y)
-        return DataIter(X, y, batch_size, self.classes, rng)
+            data_iter.map(map)
+        return data_iter
 
-    def fed_split(self, batch_sizes, mapping=None, rng=np.random.default_rng()):
+    def fed_split(self, batch_sizes, mapping=None, rng=np.random.default_rng(), epoch_shuffle=True):
         """
         Divide the dataset for federated learning.
         
@@ -105,8 +154,13 @@ class Dataset:
         - batch_sizes: the batch sizes for each client
         - mapping: a function that takes the dataset information and returns the indices for each client
         - rng: the random number generator
+        - epoch_shuffle: whether the client iterators slice batches from a per-epoch permutation,
+          otherwise each batch is sampled independently
         """
         if mapping is not None:
             distribution = mapping(*self.train(), len(batch_sizes), self.classes, rng)
-            return [self.get_iter("train", b, idx=d, rng=rng) for b, d in zip(batch_sizes, distribution)]
-        return [self.get_iter("train", b, rng=rng) for b in batch_sizes]
+            return [
+                self.get_iter("train", b, idx=d, rng=rng, epoch_shuffle=epoch_shuffle)
+                for b, d in zip(batch_sizes, distribution)
+            ]
+        return [self.get_iter("train", b, rng=rng, epoch_shuffle=epoch_shuffle) for b in batch_sizes]
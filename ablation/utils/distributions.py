@@ -40,11 +40,18 @@ def lda(X, y, nclients, nclasses, rng, alpha=0.5):
     """
     distribution = [[] for _ in range(nclients)]
     proportions = rng.dirichlet(np.repeat(alpha, nclients), size=nclasses)
+    # Sorting by label places each class in a contiguous bucket of `order`, in ascending sample order
+    order = np.argsort(y, kind='stable')
+    counts = np.bincount(y, minlength=nclasses)[:nclasses]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    split_points = np.round(np.cumsum(proportions, axis=1) * counts[:, None]).astype(int)[:, :-1]
     for c in range(nclasses):
-        idx_c = np.where(y == c)[0]
+        idx_c = order[offsets[c]:offsets[c + 1]]
         rng.shuffle(idx_c)
-        dists_c = np.split(idx_c, np.round(np.cumsum(proportions[c]) * len(idx_c)).astype(int)[:-1])
-        distribution = [distribution[i] + d.tolist() for i, d in enumerate(dists_c)]
+        dists_c = np.split(idx_c, split_points[c])
+        for i, d in enumerate(dists_c):
+            distribution[i].append(d)
+    distribution = [np.concatenate(chunks) if chunks else np.array([], dtype=order.dtype) for chunks in distribution]
     logger.info(f"distribution:\n{np.array_str(proportions, precision=4, suppress_small=True)}")
     return distribution
 
@@ -5,14 +5,25 @@ General functions for dealing with model weights.
 import numpy as np
 
 
-def uniform(weights, low=0.0, high=1.0, rng=np.random.default_rng()):
+def uniform(weights, low=0.0, high=1.0, rng=None):
     """Create an equivalently shaped tree with random number elements in the range [low, high)"""
-    return [rng.uniform(low=low, high=high, size=x.shape).astype(x.dtype) for x in weights]
+    if rng is None:
+        rng = np.random.default_rng()
+    return _split_like(rng.uniform(low=low, high=high, size=sum(x.size for x in weights)), weights)
 
 
-def add_normal(weights, loc=0.0, scale=1.0, rng=np.random.default_rng()):
+def add_normal(weights, loc=0.0, scale=1.0, rng=None):
     """Add normally distributed noise to each element of the tree, (mu=loc, sigma=scale)"""
-    return [x + rng.normal(loc=loc, scale=scale, size=x.shape).astype(x.dtype) for x in weights]
+    if rng is None:
+        rng = np.random.default_rng()
+    noise = _split_like(rng.normal(loc=loc, scale=scale, size=sum(x.size for x in weights)), weights)
+    return [x + n for x, n in zip(weights, noise)]
+
+
+def _split_like(flat, weights):
+    # Random numbers are drawn for the whole tree in one call, then split into views shaped like the weights
+    flat = flat.astype(np.result_type(*weights), copy=False)
+    return [w.astype(x.dtype, copy=False) for w, x in zip(unravel(flat, unraveller(weights)), weights)]
 
 
 def mul(weights_a, weights_b):
@@ -32,7 +43,12 @@ def scale(weights, scale):
 
 def add(*weights):
     """Element-wise add any number of pytrees"""
-    return [sum(xs) for xs in zip(*weights)]
+    # Accumulate into one buffer per layer rather than creating a temporary for every addition
+    summed = [np.array(xs[0], dtype=np.result_type(*xs)) for xs in zip(*weights)]
+    for w in weights[1:]:
+        for acc, x in zip(summed, w):
+            np.add(acc, x, out=acc)
+    return summed
 
 
 def sub(weights_a, weights_b):
@@ -42,15 +58,20 @@ def sub(weights_a, weights_b):
 
 def ravel(weights):
     """Flatten weights into a vector"""
-    return np.concatenate([np.ravel(x) for x in weights])
+    flat = np.empty(sum(x.size for x in weights), dtype=np.result_type(*weights))
+    i = 0
+    for x in weights:
+        np.copyto(flat[i:i + x.size], x.reshape(-1))
+        i += x.size
+    return flat
 
 
 def unravel(weights, skeleton):
-    """Split the weights into a tree with the specified skeleton"""
+    """Split the weights into a tree with the specified skeleton, the resulting arrays are views of the vector"""
     i = 0
     unravelled_weights = []
     for shape, length in skeleton:
-        unravelled_weights.append(np.reshape(weights[i:i + length], shape))
+        unravelled_weights.append(weights[i:i + length].reshape(shape))
         i += length
     return unravelled_weights
 
@@ -75,14 +96,45 @@ def maximum(weights, val):
 
 
 def partition(weights, skel_from, skel_to):
-    return [weights[skel_from[k]['index']][tuple(slice(i) for i in v['shape'])] for k, v in skel_to.items() if k in skel_from]
+    return partition_with(weights, partitioner(skel_from, skel_to))
+
+
+def partitioner(skel_from, skel_to):
+    """Precompute the layer index and slices taken from the weights of skel_from to form those of skel_to"""
+    return [(skel_from[k]['index'], tuple(slice(i) for i in v['shape'])) for k, v in skel_to.items() if k in skel_from]
+
+
+def partition_with(weights, partitions):
+    """Partition the weights with the slices computed by partitioner"""
+    return [np.ascontiguousarray(weights[i][s]) for i, s in partitions]
 
 def norm(weights, ord=2):
+    """Vector norm of the weights, the common orders are reduced layer by layer rather than flattening the tree"""
+    layers = [_as_inexact(x) for x in weights]
+    # Reductions start from a zero of the weights' dtype so the result has the same dtype as np.linalg.norm gives
+    zero = np.result_type(*layers).type(0)
+    if ord is None or ord == 2:
+        return np.sqrt(sum((np.vdot(x, x) for x in layers), start=zero))
+    if ord == 1:
+        return sum((np.abs(x).sum() for x in layers), start=zero)
+    if ord == np.inf:
+        return max(np.abs(x).max() for x in layers).astype(zero.dtype)
     return np.linalg.norm(ravel(weights), ord=ord)
 
 
+def _as_inexact(x):
+    # Integer layers are promoted to float as np.linalg.norm does, so their squares and sums cannot overflow
+    return x if issubclass(x.dtype.type, np.inexact) else x.astype(float)
+
+
 def counter(weights):
-    return [(w != 0).astype(w.dtype) for w in weights]
+    """Indicate the nonzero elements of the weights with ones, in the dtype of the weights"""
+    return [_nonzero(w) for w in weights]
+
+
+def _nonzero(x):
+    # The comparison is written straight into the output, avoiding a boolean temporary and a second pass to cast it
+    return np.not_equal(x, 0, out=np.empty_like(x))
 
 
 def skeleton(model):
@@ -92,7 +144,10 @@ def skeleton(model):
 def expand(weights, skel_from, skel_to):
     for k, v in skel_to.items():
         if k in skel_from:
-            weights[v['index']] = np.pad(weights[v['index']], tuple((0, b - ws) for b, ws in zip(v['shape'], weights[v['index']].shape)))
+            src = weights[v['index']]
+            dst = np.zeros(v['shape'], dtype=src.dtype)
+            dst[tuple(slice(s) for s in src.shape)] = src
+            weights[v['index']] = dst
         else:
             weights.insert(v['index'], np.zeros(v['shape']))
     return weights
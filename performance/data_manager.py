@@ -31,9 +31,20 @@ class DatasetDict:
 
         Arguments:
         - idx: Index or indices of the samples to take from the data
+
+        Selecting every sample in order returns this DatasetDict itself, so the data is shared rather than copied.
         """
+        if self._is_identity(idx):
+            return self
         return DatasetDict({k: v[idx] for k, v in self.__data.items()})
 
+    def _is_identity(self, idx: int | Iterable[int | bool]) -> bool:
+        "Check whether the indices select all of the samples in their original order."
+        return (
+            isinstance(idx, np.ndarray) and idx.dtype.kind in "iu" and len(idx) == self.length
+            and np.array_equal(idx, np.arange(self.length))
+        )
+
     def __getitem__(self, i: str) -> NDArray:
         return self.__data[i]
     
@@ -11,6 +11,11 @@ import sklearn.metrics as skm
 from . import common
 
 
+def prepare_inputs(X):
+    "Scale a batch of images stored as uint8 to floats in [0, 1], other inputs are returned as is"
+    return X.astype(np.float32) * (1 / 255) if X.dtype == np.uint8 else X
+
+
 @functools.cache
 def get_solver(create_model_fn, opt_name, loss_name, learning_rate=0.1, momentum=0.0):
     solver = jaxopt.OptaxSolver(getattr(common, loss_name)(create_model_fn()), getattr(optax, opt_name)(learning_rate, momentum=momentum))
@@ -56,7 +61,7 @@ class Model:
             if verbose:
                 idxs = tqdm(idxs)
             for idx in idxs:
-                parameters, state = self.solver_step(parameters, state, X[idx], Y[idx])
+                parameters, state = self.solver_step(parameters, state, prepare_inputs(X[idx]), Y[idx])
                 loss += state.value
                 if verbose:
                     idxs.set_postfix_str(f"Loss: {state.value:.4g}")
@@ -77,5 +82,5 @@ class Model:
 
     def evaluate(self, parameters, X, Y, batch_size=32):
         idxs = np.array_split(np.arange(len(X)), math.ceil(len(X) / batch_size))
-        preds = np.concatenate([self.predict_fn(parameters, X[idx]) for idx in idxs])
+        preds = np.concatenate([self.predict_fn(parameters, prepare_inputs(X[idx])) for idx in idxs])
         return skm.accuracy_score(Y, preds)
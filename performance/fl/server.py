@@ -101,9 +101,9 @@ def fedsum_compute(summed_grads, aux):
 def fed_sparse_avg_inc(summed_grads, client_grads, aux, client_samples):
     summed_grads = common.pytree_add(summed_grads, common.pytree_scale(client_grads, client_samples))
     if aux:
-        aux = common.pytree_add(aux, jax.tree_util.tree_map(lambda a: (a != 0) * client_samples, client_grads))
+        aux = common.pytree_add(aux, jax.tree_util.tree_map(lambda a: jnp.where(a != 0, client_samples, 0), client_grads))
     else:
-        aux = jax.tree_util.tree_map(lambda a: (a != 0) * client_samples, client_grads)
+        aux = jax.tree_util.tree_map(lambda a: jnp.where(a != 0, client_samples, 0), client_grads)
     return summed_grads, aux
 
 
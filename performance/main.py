@@ -1,4 +1,6 @@
 import argparse
+import concurrent.futures
+import multiprocessing
 import time
 from typing import Tuple
 import functools
@@ -16,83 +18,84 @@ import fl
 import data_manager
 
 
+# Increment this whenever the arrays produced by the cached loaders change, so stale caches are not loaded
+DATASET_CACHE_VERSION = 1
+
+
+def cache_dataset(load_fn):
+    """
+    Cache the train and test arrays of a dataset loader on disk, so they are loaded as memory maps on later runs
+    instead of being processed again.
+    """
+    @functools.wraps(load_fn)
+    def _load() -> data_manager.Dataset:
+        cache_dir = os.path.join("cache", f"{load_fn.__name__}-v{DATASET_CACHE_VERSION}")
+        fns = {t: {k: os.path.join(cache_dir, f"{t}_{k}.npy") for k in ['X', 'Y']} for t in ['train', 'test']}
+        if all(os.path.exists(fn) for split_fns in fns.values() for fn in split_fns.values()):
+            return data_manager.Dataset({
+                t: {k: np.load(fn, mmap_mode='r') for k, fn in split_fns.items()} for t, split_fns in fns.items()
+            })
+        dataset = load_fn()
+        os.makedirs(cache_dir, exist_ok=True)
+        for t, split_fns in fns.items():
+            for k, fn in split_fns.items():
+                # Write under a temporary name first so an interrupted run does not leave a partial cache behind
+                tmp_fn = f"{fn[:-len('.npy')]}.tmp.npy"
+                np.save(tmp_fn, dataset[t][k], allow_pickle=False)
+                os.replace(tmp_fn, fn)
+        return dataset
+    return _load
+
+
+@cache_dataset
 def mnist() -> data_manager.Dataset:
-    ds = datasets.load_dataset("mnist")
-    ds = ds.map(
-        lambda e: {
-            'X': einops.rearrange(np.array(e['image'], dtype=np.float32) / 255, "h (w c) -> h w c", c=1),
-            'Y': e['label']
-        },
-        remove_columns=['image', 'label']
-    )
-    features = ds['train'].features
-    features['X'] = datasets.Array3D(shape=(28, 28, 1), dtype='float32')
-    ds['train'] = ds['train'].cast(features)
-    ds['test'] = ds['test'].cast(features)
-    ds.set_format('numpy')
-    data = {t: {'X': ds[t]['X'], 'Y': ds[t]['Y']} for t in ['train', 'test']}
+    ds = datasets.load_dataset("mnist").with_format('numpy')
+    # The numpy format decodes each split's images into a single uint8 stack, so the processing is done batched
+    # The images are kept as uint8 and scaled for each batch by the model
+    data = {
+        t: {'X': einops.rearrange(ds[t]['image'], "b h (w c) -> b h w c", c=1), 'Y': ds[t]['label']}
+        for t in ['train', 'test']
+    }
     dataset = data_manager.Dataset(data)
     return dataset
 
 
+@cache_dataset
 def cifar10() -> data_manager.Dataset:
-    ds = datasets.load_dataset("cifar10")
-    ds = ds.map(
-        lambda e: {
-            'X': np.array(e['img'], dtype=np.float32) / 255,
-            'Y': e['label']
-        },
-        remove_columns=['img', 'label']
-    )
-    features = ds['train'].features
-    features['X'] = datasets.Array3D(shape=(32, 32, 3), dtype='float32')
-    ds['train'] = ds['train'].cast(features)
-    ds['test'] = ds['test'].cast(features)
-    ds.set_format('numpy')
-    data = {t: {'X': ds[t]['X'], 'Y': ds[t]['Y']} for t in ['train', 'test']}
+    ds = datasets.load_dataset("cifar10").with_format('numpy', columns=['img', 'label'])
+    data = {t: {'X': ds[t]['img'], 'Y': ds[t]['label']} for t in ['train', 'test']}
     dataset = data_manager.Dataset(data)
     return dataset
 
 
+@cache_dataset
 def cifar100() -> data_manager.Dataset:
-    ds = datasets.load_dataset("cifar100")
-    ds = ds.map(
-        lambda e: {
-            'X': np.array(e['img'], dtype=np.float32) / 255,
-            'Y': e['fine_label']
-        },
-        remove_columns=['img', 'fine_label', 'coarse_label']
-    )
-    features = ds['train'].features
-    features['X'] = datasets.Array3D(shape=(32, 32, 3), dtype='float32')
-    ds['train'] = ds['train'].cast(features)
-    ds['test'] = ds['test'].cast(features)
-    ds.set_format('numpy')
-    data = {t: {'X': ds[t]['X'], 'Y': ds[t]['Y']} for t in ['train', 'test']}
+    ds = datasets.load_dataset("cifar100").with_format('numpy', columns=['img', 'fine_label'])
+    data = {t: {'X': ds[t]['img'], 'Y': ds[t]['fine_label']} for t in ['train', 'test']}
     dataset = data_manager.Dataset(data)
     return dataset
 
 
+@cache_dataset
 def tinyimagenet():
-    ds = datasets.load_dataset("zh-plus/tiny-imagenet")
+    ds = datasets.load_dataset("zh-plus/tiny-imagenet").with_format('numpy')
 
-    def map_fn(e):
-        img = np.array(e['image'], dtype=np.float32) / 255
-        return {
-            "X": einops.repeat(img, "h w -> h w 3") if len(img.shape) == 2 else img,
-            "Y": e['label']
-        }
+    def to_rgb(images):
+        # Some of the images are grayscale, in which case the split comes as an object array of mixed shapes
+        if images.dtype != object:
+            return images if images.ndim == 4 else np.broadcast_to(images[..., None], images.shape + (3,))
+        grayscale = np.array([img.ndim == 2 for img in images])
+        rgb_images = np.empty((len(images), 64, 64, 3), dtype=np.uint8)
+        if (~grayscale).any():
+            rgb_images[~grayscale] = np.stack(images[~grayscale])
+        if grayscale.any():
+            rgb_images[grayscale] = np.broadcast_to(np.stack(images[grayscale])[..., None], (grayscale.sum(), 64, 64, 3))
+        return rgb_images
 
-    ds = ds.map(
-        map_fn,
-        remove_columns=['image', 'label']
-    )
-    features = ds['train'].features
-    features['X'] = datasets.Array3D(shape=(64, 64, 3), dtype='float32')
-    ds['train'] = ds['train'].cast(features)
-    ds['valid'] = ds['valid'].cast(features)
-    ds.set_format('numpy')
-    data = {"test" if t == "valid" else t: {'X': ds[t]['X'], 'Y': ds[t]['Y']} for t in ['train', 'valid']}
+    data = {
+        "test" if t == "valid" else t: {'X': to_rgb(ds[t]['image']), 'Y': ds[t]['label']}
+        for t in ['train', 'valid']
+    }
     dataset = data_manager.Dataset(data)
     return dataset
 
@@ -106,14 +109,18 @@ def lda(Y, nclients, nclasses, rng, alpha=0.5):
     - alpha: the $\alpha$ parameter of the Dirichlet function,
     the distribution is more i.i.d. as $\alpha \to \infty$ and less i.i.d. as $\alpha \to 0$
     """
-    distribution = [[] for _ in range(nclients)]
     proportions = rng.dirichlet(np.repeat(alpha, nclients), size=nclasses)
+    # Sorting by label places each class in a contiguous bucket of `order`, in ascending sample order
+    order = np.argsort(Y, kind='stable').astype(np.int32)
+    counts = np.bincount(Y, minlength=nclasses)[:nclasses]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
     for c in range(nclasses):
-        idx_c = np.where(Y == c)[0]
-        rng.shuffle(idx_c)
-        dists_c = np.split(idx_c, np.round(np.cumsum(proportions[c]) * len(idx_c)).astype(int)[:-1])
-        distribution = [distribution[i] + d.tolist() for i, d in enumerate(dists_c)]
-    return distribution
+        rng.shuffle(order[offsets[c]:offsets[c + 1]])
+    # Boundaries of each (class, client) chunk within `order`, the last client of a class takes the remainder
+    bounds = np.round(np.cumsum(proportions, axis=1) * counts[:, None]).astype(int) + offsets[:-1, None]
+    bounds[:, -1] = offsets[1:]
+    chunks = np.split(order[:offsets[-1]], bounds.ravel()[:-1])
+    return [np.concatenate(chunks[i::nclients]) for i in range(nclients)]
 
 
 def har() -> Tuple[data_manager.Dataset, NDArray]:
@@ -127,26 +134,75 @@ def har() -> Tuple[data_manager.Dataset, NDArray]:
 def nbaiot() -> Tuple[data_manager.Dataset, NDArray]:
     ds = datasets.load_dataset("codymlewis/nbaiot")
     ds.set_format('numpy')
-    mean_vals = np.mean(ds['train']['features'], axis=0)
-    std_vals = np.std(ds['train']['features'], dtype=np.float64, axis=0).astype(np.float32)
-    ds = ds.map(lambda e: {
-        'features': (e['features'] - mean_vals) / std_vals,  # Normalise
-        'attack': 0 if e['attack'] == 0 else 1,  # Make the dataset binary: 0=benign, 1=attack
-        'device': e['device'],
-    })
+    train_features = ds['train']['features']
+    mean_vals = np.mean(train_features, axis=0)
+    std_vals = np.std(train_features, dtype=np.float64, axis=0).astype(np.float32)
+    std_vals = np.where(std_vals == 0, 1, std_vals)  # Leave constant features at zero
     rng = np.random.default_rng(0)
     idxs = {t: rng.choice(len(ds[t]), len(ds[t]) // 10, replace=False) for t in ['train', 'test']}
-    data = {t: {'X': ds[t]['features'][idxs[t]], 'Y': ds[t]['attack'][idxs[t]]} for t in ['train', 'test']}
+    # Only the retained rows of each split are converted from the dataset, the train features are already loaded
+    subsets = {t: ds[t].select(idxs[t]) for t in ['train', 'test']}
+    features = {'train': train_features[idxs['train']], 'test': np.require(subsets['test']['features'], requirements='W')}
+    del train_features
+    data = {}
+    for t in ['train', 'test']:
+        X = features[t]
+        # Normalise in place over the whole split
+        np.subtract(X, mean_vals, out=X)
+        np.divide(X, std_vals, out=X)
+        # Make the dataset binary: 0=benign, 1=attack
+        data[t] = {'X': X, 'Y': (subsets[t]['attack'] != 0).astype(np.int64)}
     dataset = data_manager.Dataset(data)
-    return dataset, ds['train']['device'][idxs['train']]
+    return dataset, subsets['train']['device']
 
 
 def client_ids_to_idx(ids):
-    idx = np.arange(len(ids))
-    client_idx = []
-    for cid in np.unique(ids):
-        client_idx.append(idx[ids == cid])
-    return client_idx
+    # A stable sort groups the samples of each client in ascending order, with clients in the order of np.unique
+    order = np.argsort(ids, kind='stable')
+    _, counts = np.unique(ids, return_counts=True)
+    return np.split(order, np.cumsum(counts)[:-1])
+
+
+_local_worker_create_model_fn = None
+_local_worker_test_data = None
+
+
+def init_local_worker(create_model_fn, test_data, core_groups, worker_counter):
+    "Hold the model function and shared test split in this worker process and pin it to its share of the cores"
+    global _local_worker_create_model_fn, _local_worker_test_data
+    _local_worker_create_model_fn = create_model_fn
+    _local_worker_test_data = test_data
+    with worker_counter.get_lock():
+        worker_id = worker_counter.value
+        worker_counter.value += 1
+    if hasattr(os, "sched_setaffinity"):
+        # XLA sizes its CPU thread pool by the schedulable cores, so this also limits the threads of the worker
+        os.sched_setaffinity(0, core_groups[worker_id % len(core_groups)])
+
+
+@functools.cache
+def local_worker_model_fn(pw, pd):
+    # Reusing one partial per allocation lets the solver and predictor caches of fl.model hit across clients
+    return functools.partial(_local_worker_create_model_fn, pw, pd)
+
+
+def train_local_client(pw, pd, input_shape, train_data, batch_size, epochs, steps_per_epoch, seed):
+    # Clients are constructed within the worker, as the compiled functions of the model cannot be sent between processes
+    client = fl.client.Local(
+        fl.model.Model(local_worker_model_fn(pw, pd), input_shape, "sgd", "crossentropy_loss", seed=seed),
+        data_manager.Dataset({"train": train_data, "test": _local_worker_test_data}),
+        batch_size,
+        epochs,
+        steps_per_epoch,
+    )
+    parameters = client.model.init_parameters()
+    loss, parameters = client.step(parameters)
+    return loss, client.analytics(parameters)
+
+
+def available_cores():
+    "Get the cores this process may run on"
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
 
 
 if __name__ == "__main__":
@@ -169,6 +225,8 @@ if __name__ == "__main__":
                         help="Proportion of clients that the server selects for training in each round.")
     parser.add_argument("-q", "--quantisation", action="store_true",
                         help="Whether to use SecAgg quantisation (applicable to FedAVG and PPDHFL algorithms only)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of processes to train the clients of the local framework in (0 uses one per core).")
     args = parser.parse_args()
     print(f"Starting experiment with config: {args.__dict__}")
 
@@ -220,6 +278,7 @@ if __name__ == "__main__":
             for pw, pd in zip(*allocation_scheme)
         ])
 
+    workers = args.workers if args.workers > 0 else len(available_cores())
     if args.framework == "feddrop":
         clients = [
             fl.client.FedDrop(
@@ -232,6 +291,9 @@ if __name__ == "__main__":
                 seed=args.seed,
             ) for cidx in client_idx
         ]
+    elif args.framework == "local" and workers > 1:
+        local_allocations = itertools.cycle(zip(*allocation_scheme))
+        local_clients = [(next(local_allocations), dataset['train'].select(cidx)) for cidx in client_idx]
     else:
         client_cls = fl.client.Local if args.framework == "local" else fl.client.Client
         clients = [
@@ -245,13 +307,50 @@ if __name__ == "__main__":
         ]
     if args.framework == "local":
         client_analytics = []
-        for client in (pbar := tqdm(clients)):
-            parameters = client.model.init_parameters()
-            client.epochs = args.epochs * args.rounds
-            loss, parameters = client.step(parameters)
-            client_analytics.append(client.analytics(parameters))
-            pbar.set_postfix_str(f"Loss: {loss:.3f}, ACC: {client_analytics[-1]:.3%}")
-            del client
+        if workers == 1:
+            for client in (pbar := tqdm(clients)):
+                parameters = client.model.init_parameters()
+                client.epochs = args.epochs * args.rounds
+                loss, parameters = client.step(parameters)
+                client_analytics.append(client.analytics(parameters))
+                pbar.set_postfix_str(f"Loss: {loss:.3f}, ACC: {client_analytics[-1]:.3%}")
+                del client
+        else:
+            # Divide the cores between the workers so their thread pools do not oversubscribe them
+            cores = available_cores()
+            threads_per_client = max(1, len(cores) // workers)
+            core_groups = [
+                cores[i * threads_per_client:(i + 1) * threads_per_client]
+                for i in range(len(cores) // threads_per_client)
+            ]
+            # These are read when the workers start, before NumPy's BLAS and the XLA backend are loaded
+            os.environ["OMP_NUM_THREADS"] = str(threads_per_client)
+            if threads_per_client == 1:
+                os.environ["XLA_FLAGS"] = f"{os.environ.get('XLA_FLAGS', '')} --xla_cpu_multi_thread_eigen=false"
+            mp_context = multiprocessing.get_context("spawn")
+            with concurrent.futures.ProcessPoolExecutor(
+                workers,
+                mp_context=mp_context,
+                initializer=init_local_worker,
+                initargs=(create_model_fn, dataset['test'], core_groups, mp_context.Value('i', 0)),
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        train_local_client,
+                        pw,
+                        pd,
+                        dataset.input_shape,
+                        train_data,
+                        args.batch_size,
+                        args.epochs * args.rounds,
+                        args.steps_per_epoch,
+                        args.seed,
+                    ) for (pw, pd), train_data in local_clients
+                ]
+                for future in (pbar := tqdm(concurrent.futures.as_completed(futures), total=len(futures))):
+                    loss, analytics = future.result()
+                    client_analytics.append(analytics)
+                    pbar.set_postfix_str(f"Loss: {loss:.3f}, ACC: {client_analytics[-1]:.3%}")
         results = {
             "analytics": [{
                 "mean": np.mean(client_analytics),
@@ -286,7 +385,7 @@ if __name__ == "__main__":
     print(f"Finished in {time.time() - start_time:.3f} seconds")
 
     os.makedirs("results", exist_ok=True)
-    arg_specs = "_".join([f"{k}={v}" for k, v in args.__dict__.items() if k not in ["gen_plot_data"]])
+    arg_specs = "_".join([f"{k}={v}" for k, v in args.__dict__.items() if k not in ["gen_plot_data", "workers"]])
     filename = f"results/{arg_specs}.json"
     with open(filename, 'w') as f:
         json.dump(results, f)
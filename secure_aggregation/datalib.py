@@ -11,12 +11,18 @@ def lda(labels, nclients, nclasses, rng, alpha=0.5):
     """
     distribution = [[] for _ in range(nclients)]
     proportions = rng.dirichlet(np.repeat(alpha, nclients), size=nclasses)
+    # Sorting by label places each class in a contiguous bucket of `order`, in ascending sample order
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels, minlength=nclasses)[:nclasses]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    split_points = np.round(np.cumsum(proportions, axis=1) * counts[:, None]).astype(int)[:, :-1]
     for c in range(nclasses):
-        idx_c = np.where(labels == c)[0]
+        idx_c = order[offsets[c]:offsets[c + 1]]
         rng.shuffle(idx_c)
-        dists_c = np.split(idx_c, np.round(np.cumsum(proportions[c]) * len(idx_c)).astype(int)[:-1])
-        distribution = [distribution[i] + d.tolist() for i, d in enumerate(dists_c)]
-    return distribution
+        dists_c = np.split(idx_c, split_points[c])
+        for i, d in enumerate(dists_c):
+            distribution[i].append(d)
+    return [np.concatenate(chunks) if chunks else np.array([], dtype=order.dtype) for chunks in distribution]
 
 
 class DataIter:
@@ -75,10 +81,9 @@ class Dataset:
         - idx: the indices to use
         - rng: the random number generator
         """
-        X, Y = self.ds[split]['X'], self.ds[split]['Y']
-        if idx is not None:
-            X, Y = X[idx], Y[idx]
-        return DataIter(X, Y, batch_size, self.classes, rng)
+        # Select before reading the columns so only the requested samples are materialised, rather than the whole split
+        split_ds = self.ds[split] if idx is None else self.ds[split].select(idx)
+        return DataIter(split_ds['X'], split_ds['Y'], batch_size, self.classes, rng)
 
     def fed_split(self, batch_sizes, mapping=None, rng=np.random.default_rng()):
         """